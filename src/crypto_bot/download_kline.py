@@ -11,17 +11,77 @@ import sys
 from datetime import *
 import pandas as pd
 
-from utility import download_file, get_all_symbols, get_parser, get_start_end_date_objects, convert_to_date_object, \
+from utility import download_files, get_save_path, get_all_symbols, get_parser, get_start_end_date_objects, convert_to_date_object, \
   get_path
 
 from datetime import *
 
 from enums import *
+import hashlib
+import io
 import zipfile
+import zlib
 import os
-
-
-def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum):
+from concurrent.futures import ProcessPoolExecutor
+
+
+def read_kline_zip(zip_bytes):
+  with zipfile.ZipFile(io.BytesIO(zip_bytes)) as z:
+    return pd.read_csv(z.open(z.namelist()[0]), header=None)
+
+def _safe_read_kline_zip(job):
+  # one corrupt or empty file must not throw away every other frame in the batch
+  file_name, zip_bytes = job
+  try:
+    return read_kline_zip(zip_bytes)
+  except (zipfile.BadZipFile, zlib.error, EOFError, IndexError, ValueError) as e:
+    print("\nCould not read {}: {}".format(file_name, e))
+    return None
+
+def _discard(path, file_name, folder):
+  # the bad copy would otherwise be served from disk on every later run
+  save_path = get_save_path(path, file_name, folder)
+  if os.path.exists(save_path):
+    os.remove(save_path)
+
+def _download_klines(jobs, folder, checksum, backoff, max_backoff, revalidate=()):
+  files = list(jobs)
+  if checksum == 1:
+    files += [(path, file_name + ".CHECKSUM") for path, file_name in jobs]
+  contents = download_files(files, folder, backoff, max_backoff, revalidate)
+
+  zips = []
+  for i, (path, file_name) in enumerate(jobs):
+    zip_bytes = contents[i]
+    if zip_bytes is None:
+      continue
+    if checksum == 1 and contents[len(jobs) + i] is None:
+      print("\nChecksum not available, skipping verification: {}{}".format(path, file_name))
+    elif checksum == 1:
+      expected = contents[len(jobs) + i].split()[0].decode()
+      if hashlib.sha256(zip_bytes).hexdigest() != expected:
+        print("\nChecksum mismatch: {}{}".format(path, file_name))
+        _discard(path, file_name, folder)
+        continue
+    zips.append((path, file_name, zip_bytes))
+
+  # inflate + parse is CPU bound, so spread it across processes rather than threads
+  decode_jobs = [(file_name, zip_bytes) for path, file_name, zip_bytes in zips]
+  if len(zips) <= 1:
+    frames = [_safe_read_kline_zip(job) for job in decode_jobs]
+  else:
+    with ProcessPoolExecutor(max_workers=min(len(zips), os.cpu_count() or 1)) as pool:
+      frames = list(pool.map(_safe_read_kline_zip, decode_jobs))
+
+  decoded = []
+  for (path, file_name, _), frame in zip(zips, frames):
+    if frame is None:
+      _discard(path, file_name, folder)
+    else:
+      decoded.append(frame)
+  return decoded
+
+def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years, months, start_date, end_date, folder, checksum, backoff=1, max_backoff=64, ingested_months=()):
   current = 0
   date_range = None
 
@@ -40,34 +100,28 @@ def download_monthly_klines(trading_type, symbols, num_symbols, intervals, years
 
   print("Found {} symbols".format(num_symbols))
 
+  jobs = []
+  revalidate = []
   for symbol in symbols:
     print("[{}/{}] - start download monthly {} klines ".format(current+1, num_symbols, symbol))
     for interval in intervals:
       #for year in years:
+        path = get_path(trading_type, "klines", "monthly", symbol, interval)
         for month in months:
           #current_date = convert_to_date_object(date)
           current_date = convert_to_date_object('{}-01'.format(month))
           if current_date >= start_date and current_date <= end_date:
-            path = get_path(trading_type, "klines", "monthly", symbol, interval)
             file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, month)
-            file_path=download_file(path, file_name, None, folder)
-
-            if os.path.exists(file_path):
-              with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(folder)
-
-            if checksum == 1:
-              checksum_path = get_path(trading_type, "klines", "monthly", symbol, interval)
-              checksum_file_name = "{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, month)
-              file_path=download_file(checksum_path, checksum_file_name, None, folder)
-
-              if os.path.exists(file_path):
-                with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                  zip_ref.extractall(folder)
+            jobs.append((path, file_name))
+            # rows from these months are already merged, so an unchanged file need not be re-sent
+            if month in ingested_months:
+              revalidate.append((path, file_name))
 
     current += 1
 
-def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum):
+  return _download_klines(jobs, folder, checksum, backoff, max_backoff, revalidate)
+
+def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates, start_date, end_date, folder, checksum, backoff=1, max_backoff=64):
   current = 0
   date_range = None
 
@@ -88,37 +142,25 @@ def download_daily_klines(trading_type, symbols, num_symbols, intervals, dates,
   intervals = list(set(intervals) & set(DAILY_INTERVALS))
   print("Found {} symbols".format(num_symbols))
 
+  jobs = []
   for symbol in symbols:
     print("[{}/{}] - start download daily {} klines ".format(current+1, num_symbols, symbol))
     for interval in intervals:
       print(f"Processing dates {dates}")
+      path = get_path(trading_type, "klines", "daily", symbol, interval)
       for date in dates:
         current_date = convert_to_date_object(date)
         
         if current_date >= start_date and current_date <= end_date:
-          path = get_path(trading_type, "klines", "daily", symbol, interval)
           file_name = "{}-{}-{}.zip".format(symbol.upper(), interval, date)
 
-          print(f"Processing dates {current_date} for {start_date} : {end_date}")
-          print(f"Downloading daily klines for {symbol} {interval} on {date} : {file_name} : {path} : { folder }")
-          file_path=download_file(path, file_name, None, folder)
-          print("file_path: ", file_path)
-          # Unzip the downloaded file into the folder directory
-          #file_path = os.path.join(folder, file_name)
-          if os.path.exists(file_path):
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-              zip_ref.extractall(folder)
-
-          if checksum == 1:
-            checksum_path = get_path(trading_type, "klines", "daily", symbol, interval)
-            checksum_file_name = "{}-{}-{}.zip.CHECKSUM".format(symbol.upper(), interval, date)
-            checksum_path=download_file(checksum_path, checksum_file_name, None, folder)
-            if os.path.exists(checksum_path):
-              with zipfile.ZipFile(checksum_path, 'r') as zip_ref:
-                zip_ref.extractall(folder)
+          print(f"Queueing daily klines for {symbol} {interval} on {date} : {file_name} : {path} : { folder }")
+          jobs.append((path, file_name))
 
     current += 1
 
+  return _download_klines(jobs, folder, checksum, backoff, max_backoff)
+
 # if __name__ == "__main__":
 #     parser = get_parser('klines')
 #     args = parser.parse_args(sys.argv[1:])
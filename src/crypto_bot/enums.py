@@ -7,5 +7,15 @@ TRADING_TYPE = ["spot", "um", "cm"]
 MONTHS = list(range(1,13))
 PERIOD_START_DATE = '2020-01-01'
 BASE_URL = 'https://data.binance.vision/'
+MAX_CONNECTIONS = 64
+MAX_CONNECTIONS_PER_HOST = 32
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+HEDGE_WINDOW = 256
+HEDGE_MIN_SAMPLES = 16
+HEDGE_DELAY_FACTOR = 1.5
+HEDGE_MAX_INFLIGHT = 4
+RATE_LIMIT_COOLDOWN = 30
+FETCH_RETRIES = 5
+ETAG_INDEX_PATH = '~/.cache/binance_dl/index.sqlite'
 START_DATE = date(int(YEARS[0]), MONTHS[0], 1)
 END_DATE = datetime.date(datetime.now())
\ No newline at end of file
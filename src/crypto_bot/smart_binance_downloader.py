@@ -1,43 +1,167 @@
 import os
+import csv
+import heapq
 import time
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+from datetime import date, datetime, timedelta
 
 # Import the official download functions
 from download_kline import download_monthly_klines, download_daily_klines
+from utility import get_backoff_sleep
 
+EPOCH = date(1970, 1, 1)
+MS_PER_DAY = 86_400_000
+MERGE_BATCH_ROWS = 65_536
 
-def daterange(start_date, end_date):
-  for n in range(int((end_date - start_date).days) + 1):
-    yield start_date + timedelta(n)
+def to_epoch_day(d):
+  return (d - EPOCH).days
 
-def get_months_between(start_date, end_date):
-  months = []
-  current = start_date.replace(day=1)
-  while current <= end_date:
-    months.append(current)
-    current += relativedelta(months=1)
-  return months
+def classify_missing(start_day, end_day, existing_days):
+  """Split the epoch days in [start_day, end_day] missing from existing_days into monthly and daily downloads.
+
+  Returns (monthly_ranges, daily_days): an (n, 2) array of [month_first, next_month_first) epoch days for
+  months fully inside the range with at least one missing day, and the remaining missing days.
+  """
+  wanted = np.arange(start_day, end_day + 1, dtype='int64')
+  missing = wanted[~np.isin(wanted, existing_days, assume_unique=True)]
+
+  months = np.arange(np.datetime64(EPOCH + timedelta(days=int(start_day)), 'M'),
+                     np.datetime64(EPOCH + timedelta(days=int(end_day)), 'M') + 1)
+  month_first = months.astype('datetime64[D]').astype('int64')
+  month_last = (months + 1).astype('datetime64[D]').astype('int64') - 1
+  lo = np.searchsorted(missing, np.maximum(month_first, start_day))
+  hi = np.searchsorted(missing, np.minimum(month_last, end_day), side='right')
+  monthly = (hi > lo) & (month_first >= start_day) & (month_last <= end_day)
+
+  month_of_day = np.searchsorted(month_first, missing, side='right') - 1
+  monthly_ranges = np.stack([month_first[monthly], month_last[monthly] + 1], axis=1)
+  return monthly_ranges, missing[~monthly[month_of_day]]
+
+def get_days_sidecar(csv_path):
+  return os.path.splitext(csv_path)[0] + ".days.bin"
+
+def get_feather_sidecar(csv_path):
+  return os.path.splitext(csv_path)[0] + ".feather"
+
+def open_feather(feather_path, options=None):
+  return pa.ipc.open_file(pa.memory_map(feather_path), options=options)
+
+def is_fresh(sidecar, csv_path):
+  return os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(csv_path)
+
+def write_existing_dates(csv_path, days):
+  # packed bitmap indexed by epoch day: bit n set means day n is in the CSV
+  days = np.asarray(sorted(days), dtype='int64')
+  bitmap = np.zeros(days[-1] + 1 if len(days) else 0, dtype=np.uint8)
+  bitmap[days] = 1
+  np.packbits(bitmap).tofile(get_days_sidecar(csv_path))
 
 def get_existing_dates(csv_path):
   if not os.path.exists(csv_path):
     return set()
-  df = pd.read_csv(csv_path, header=None)
-  return set(pd.to_datetime(df[0], unit='ms').dt.date)
+  sidecar = get_days_sidecar(csv_path)
+  if is_fresh(sidecar, csv_path):
+    return set(np.nonzero(np.unpackbits(np.fromfile(sidecar, dtype=np.uint8)))[0].tolist())
+  feather_path = get_feather_sidecar(csv_path)
+  if is_fresh(feather_path, csv_path):
+    # decompress only f0, one batch at a time
+    reader = open_feather(feather_path, options=pa.ipc.IpcReadOptions(included_fields=[0]))
+    open_times = (reader.get_batch(i).column(0) for i in range(reader.num_record_batches))
+  else:
+    # only the open-time column is needed: project it in pyarrow's parser and bucket into days there
+    table = pv.read_csv(
+      csv_path,
+      read_options=pv.ReadOptions(autogenerate_column_names=True),
+      convert_options=pv.ConvertOptions(include_columns=['f0'], column_types={'f0': pa.int64()}),
+    )
+    open_times = [table['f0']]
+  days = set()
+  for column in open_times:
+    days.update(pc.unique(pc.divide(column, MS_PER_DAY)).to_pylist())
+  write_existing_dates(csv_path, days)
+  return days
+
+def iter_kline_rows(csv_path):
+  # stream the CSV in record batches on pyarrow's multithreaded parser instead of loading it whole
+  reader = pv.open_csv(
+    csv_path,
+    read_options=pv.ReadOptions(autogenerate_column_names=True),
+    convert_options=pv.ConvertOptions(column_types={'f0': pa.int64()}),
+  )
+  for batch in reader:
+    yield from zip(*(column.to_pylist() for column in batch.columns))
+
+def iter_feather_rows(feather_path):
+  # record batches are compressed independently, so only the batch being merged is ever decompressed
+  reader = open_feather(feather_path)
+  for i in range(reader.num_record_batches):
+    yield from zip(*(column.to_pylist() for column in reader.get_batch(i).columns))
+
+def merge_klines(csv_path, new_data):
+  # both inputs are sorted by open time, so a streaming k-way merge replaces concat + sort;
+  # the old data comes first so its row wins when an open time repeats
+  sources = [new_data.sort_values(by=0, kind='stable').itertuples(index=False, name=None)]
+  feather_path = get_feather_sidecar(csv_path)
+  if os.path.exists(csv_path):
+    # the zstd feather mirror is columnar and memory-mapped, so prefer it over re-parsing the CSV
+    sources.insert(0, iter_feather_rows(feather_path) if is_fresh(feather_path, csv_path) else iter_kline_rows(csv_path))
+  tmp_path = csv_path + ".tmp"
+  tmp_feather_path = feather_path + ".tmp"
+  ipc_writer = None
+  schema = None
+  chunk = []
+
+  def flush():
+    nonlocal ipc_writer, schema
+    writer.writerows(chunk)
+    columns = list(zip(*chunk))
+    if ipc_writer is None:
+      # the first batch fixes the column types for the rest of the file
+      batch = pa.RecordBatch.from_arrays([pa.array(column) for column in columns], names=[f"f{i}" for i in range(len(columns))])
+      schema = batch.schema
+      ipc_writer = pa.ipc.new_file(tmp_feather_path, schema, options=pa.ipc.IpcWriteOptions(compression='zstd'))
+    else:
+      batch = pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)], schema=schema)
+    ipc_writer.write_batch(batch)
+    chunk.clear()
+
+  prev_ts = None
+  try:
+    with open(tmp_path, 'w', newline='') as out_file:
+      writer = csv.writer(out_file)
+      for row in heapq.merge(*sources, key=lambda row: row[0]):
+        ts = row[0]
+        if ts == prev_ts:
+          continue
+        prev_ts = ts
+        chunk.append(row)
+        if len(chunk) >= MERGE_BATCH_ROWS:
+          flush()
+      if chunk:
+        flush()
+  finally:
+    if ipc_writer is not None:
+      ipc_writer.close()
+  os.replace(tmp_path, csv_path)
+  if ipc_writer is not None:
+    os.replace(tmp_feather_path, feather_path)
 
 def download_with_backoff(download_func, rate_limit_sleep, max_backoff, *args, **kwargs):
-  sleep_time = rate_limit_sleep
+  attempts = 0
   while True:
     try:
-      download_func(*args, **kwargs)
-      return
+      return download_func(*args, **kwargs)
     except Exception as e:
       # Check for HTTP 429 or rate limit in error message
       if "429" in str(e) or "rate limit" in str(e).lower():
-        print(f"Rate limited. Sleeping for {sleep_time} seconds...")
+        attempts += 1
+        sleep_time = get_backoff_sleep(rate_limit_sleep, attempts, max_backoff)
+        print(f"Rate limited. Sleeping for {sleep_time:.1f} seconds...")
         time.sleep(sleep_time)
-        sleep_time = min(sleep_time * 2, max_backoff)
       else:
         raise
 
@@ -47,7 +171,7 @@ def main(symbol, interval, start_date, end_date, rate_limit_sleep, max_backoff,
     existing_dates = get_existing_dates(merged_csv)
 
 
-    print(f"Existing dates in {merged_csv}: {existing_dates}")
+    print(f"Found {len(existing_dates)} existing dates in {merged_csv}")
     market_type = "spot"
     # Determine num_symbols based on symbol input
     if "," in symbol:
@@ -55,83 +179,53 @@ def main(symbol, interval, start_date, end_date, rate_limit_sleep, max_backoff,
         num_symbols = len(set(symbols_list))
     else:
         num_symbols = 1
-    months = get_months_between(start_date, end_date)
-    files_to_download = []
-
-
-
-    for month in months:
-        month_start = month
-        month_end = (month + relativedelta(months=1)) - timedelta(days=1)
-        # Check if all dates in the month are missing from existing_dates
-        month_dates = set(daterange(max(month_start, start_date), min(month_end, end_date)))
-        if month_start >= start_date and month_end <= end_date and not month_dates.issubset(existing_dates):
-            files_to_download.append(("monthly", (month, month + relativedelta(months=1))))
-        else:
-            for single_date in daterange(max(month_start, start_date), min(month_end, end_date)):
-                if single_date not in existing_dates:
-                    files_to_download.append(("daily", (single_date, single_date + timedelta(days=1))))
-
+    existing = np.array(sorted(existing_dates), dtype='int64')
+    start_day = to_epoch_day(start_date)
+    monthly_ranges, daily_days = classify_missing(start_day, to_epoch_day(end_date), existing)
+
+    # format every date and month once, then index by offset from start_date
+    date_strs = pd.date_range(start_date, end_date, freq='D').strftime('%Y-%m-%d').to_numpy()
+    month_strs = pd.date_range(start_date.replace(day=1), end_date, freq='MS').strftime('%Y-%m').to_numpy()
+    month_offsets = (monthly_ranges[:, 0].astype('datetime64[D]').astype('datetime64[M]')
+                     - np.datetime64(start_date, 'M')).astype('int64')
+
+    # one work list per frequency, each fetched as a single batch
+    work = {
+        "monthly": month_strs[month_offsets].tolist(),
+        "daily": date_strs[daily_days - start_day].tolist(),
+    }
+
+    # months that already have rows in the merged data; their monthly file was ingested before
+    ingested = np.searchsorted(existing, monthly_ranges[:, 1]) > np.searchsorted(existing, monthly_ranges[:, 0])
+    ingested_months = {month for month, seen in zip(work["monthly"], ingested) if seen}
+
+    out_dir = os.path.join(data_dir, f"{symbol}_{interval}_data")
+    os.makedirs(out_dir, exist_ok=True)
     all_new_rows = []
-    for freq, date in files_to_download:
-        out_dir = os.path.join(data_dir, f"{symbol}_{interval}_data")
-        os.makedirs(out_dir, exist_ok=True)
-        print(f"Processing {freq} data for {symbol} {interval} from {date[0]} to {date[1]}...")
+    for freq, spans in work.items():
+        if not spans:
+            continue
+        print(f"Downloading {len(spans)} {freq} files for {symbol} {interval} : {out_dir}")
         try:
             if freq == "monthly":
-
-                # 'date' here is a tuple: (month_start, month_end)
-                month_start, month_end = date
-                # Create a list of months between month_start and month_end (inclusive)
-                months = []
-                current_month = month_start
-                while current_month <= (month_end - timedelta(days=1)):
-                    months.append(current_month.strftime('%Y-%m'))
-                    current_month += relativedelta(months=1)
-                # months now contains all months in the range
-                month_start = month_start.strftime('%Y-%m-%d')
-                month_end = month_end.strftime('%Y-%m-%d')
-                download_with_backoff(download_monthly_klines, rate_limit_sleep, max_backoff, market_type,[symbol],num_symbols, [interval], None,months,month_start, month_end, out_dir, cksum)
-                
-
-                fname = f"{symbol}-{interval}-{month_start}.csv"
-                print(f"Downloading monthly data for {symbol} {interval} from {month_start} to {month_end} : {fname} : {out_dir}")
+                frames = download_with_backoff(download_monthly_klines, rate_limit_sleep, max_backoff, market_type,[symbol],num_symbols, [interval], None,spans,start_date.isoformat(), end_date.isoformat(), out_dir, cksum, rate_limit_sleep, max_backoff, ingested_months)
             else:
-                # 'date' here is a tuple: (day_start, day_end)
-                day_start, day_end = date
-                day_start = day_start.strftime('%Y-%m-%d')
-                day_end = day_end.strftime('%Y-%m-%d')
-
-                print(f"Downloading daily data for {symbol} {interval} from {day_start} to {day_end}  : {out_dir}")
-
-                download_with_backoff(download_daily_klines, rate_limit_sleep, max_backoff, market_type,[symbol],num_symbols, [interval], [day_start],day_start, day_end, out_dir, cksum)
-                #day_start, day_end = date
-                fname = f"{symbol}-{interval}-{day_start}.csv"
-
-            csv_path = os.path.join(out_dir, fname)
-            if os.path.exists(csv_path):
-                df = pd.read_csv(csv_path, header=None)
-                df['date'] = pd.to_datetime(df[0], unit='ms').dt.date
-                df = df[~df['date'].isin(existing_dates)] 
-                all_new_rows.append(df.drop(columns=['date']))
-            # Clean up
-            #for f in os.listdir(out_dir):
-            #    os.remove(os.path.join(out_dir, f))
+                frames = download_with_backoff(download_daily_klines, rate_limit_sleep, max_backoff, market_type,[symbol],num_symbols, [interval], spans,start_date.isoformat(), end_date.isoformat(), out_dir, cksum, rate_limit_sleep, max_backoff)
+
+            for df in frames:
+                df = df[~(df[0] // MS_PER_DAY).isin(existing_dates)]
+                if len(df):
+                    all_new_rows.append(df)
             time.sleep(rate_limit_sleep)
         except Exception as e:
             import traceback
             traceback.print_exc()
-            print(f"Error processing {freq} {date}: {e}")
+            print(f"Error processing {freq} {spans}: {e}")
 
     if all_new_rows:
         new_data = pd.concat(all_new_rows)
-        if os.path.exists(merged_csv):
-            old_data = pd.read_csv(merged_csv, header=None)
-            merged = pd.concat([old_data, new_data]).drop_duplicates(subset=[0])
-        else:
-            merged = new_data
-        merged.sort_values(by=0, inplace=True)
-        merged.to_csv(merged_csv, header=False, index=False)
+        merge_klines(merged_csv, new_data)
+        write_existing_dates(merged_csv, existing_dates | set((new_data[0] // MS_PER_DAY).tolist()))
         print(f"Updated {merged_csv} with new data.")
     else:
         print("No new data to add.")
@@ -1,8 +1,20 @@
 import os, sys, re, shutil
+import io
 import json
+import functools
+import contextlib
+import collections
+import statistics
+import random
+import hashlib
+import sqlite3
+import asyncio
+import aiohttp
+import aiofiles
 from pathlib import Path
 from datetime import *
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser, RawTextHelpFormatter, ArgumentTypeError
 from enums import *
 
@@ -14,6 +26,11 @@ def get_destination_dir(file_url, folder=None):
     store_directory = os.path.dirname(os.path.realpath(__file__))
   return os.path.join(store_directory, file_url)
 
+def get_save_path(base_path, file_name, folder=None):
+  if folder:
+    base_path = os.path.join(folder, base_path)
+  return get_destination_dir(os.path.join(base_path, file_name), None)
+
 def get_download_url(file_url):
   return "{}{}".format(BASE_URL, file_url)
 
@@ -26,50 +43,237 @@ def get_all_symbols(type):
     response = urllib.request.urlopen("https://api.binance.com/api/v3/exchangeInfo").read()
   return list(map(lambda symbol: symbol['symbol'], json.loads(response)['symbols']))
 
-def download_file(base_path, file_name, date_range=None, folder=None):
-  download_path = "{}{}".format(base_path, file_name)
-  if folder:
-     base_path = os.path.join(folder, base_path)
-  if date_range:
-    date_range = date_range.replace(" ","_")
-    base_path = os.path.join(base_path, date_range)
-  save_path = get_destination_dir(os.path.join(base_path, file_name), None)
-  
-
-  if os.path.exists(save_path):
-    print("\nfile already exists! {}".format(save_path))
-    return save_path
-  
-  # make the directory
-  if not os.path.exists(base_path):
-    Path(get_destination_dir(base_path)).mkdir(parents=True, exist_ok=True)
+async def _get_body(session, url, headers=None, rates=None, on_headers=None):
+  async with session.get(url, headers=headers) as resp:
+    if resp.status == 304:
+      return resp.status, resp.headers.get("ETag"), None
+    if on_headers is not None:
+      on_headers(resp.content_length)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    bio = io.BytesIO()
+    async for buf in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+      bio.write(buf)
+    body = bio.getvalue()
+    elapsed = loop.time() - started
+    # a body that fits in one read measures latency, not bandwidth
+    if rates is not None and len(body) >= DOWNLOAD_CHUNK_SIZE and elapsed > 0:
+      rates.append(len(body) / elapsed)
+    return resp.status, resp.headers.get("ETag"), body
+
+# transfer rates in bytes/sec, shared across download_files calls; being size-normalised,
+# samples from small daily files still give a fair deadline for large monthly ones
+_rates = collections.deque(maxlen=HEDGE_WINDOW)
+
+async def _hedged_get(session, url, rates, hedge_slots, headers=None):
+  # once headers give the size, duplicate transfers running well below the typical rate and keep whichever finishes first
+  loop = asyncio.get_running_loop()
+  length = loop.create_future()
+
+  def on_headers(content_length):
+    if not length.done():
+      length.set_result(content_length)
+
+  primary = asyncio.create_task(_get_body(session, url, headers, rates, on_headers))
+  pending = {primary}
+  hedged = False
+  try:
+    done = set()
+    if len(rates) >= HEDGE_MIN_SAMPLES:
+      await asyncio.wait({primary, length}, return_when=asyncio.FIRST_COMPLETED)
+      size = length.result() if length.done() else None
+      if not primary.done() and size and size >= DOWNLOAD_CHUNK_SIZE:
+        done, pending = await asyncio.wait(pending, timeout=HEDGE_DELAY_FACTOR * size / statistics.median(rates))
+        # hedges only use the connector headroom the limiter leaves free; skip when it is taken
+        if not done and not hedge_slots.locked():
+          await hedge_slots.acquire()
+          hedged = True
+          print("\nHedging slow download: {}".format(url))
+          pending.add(asyncio.create_task(_get_body(session, url, headers, rates)))
+    if not done:
+      done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    return done.pop().result()
+  finally:
+    for task in pending:
+      task.cancel()
+    if hedged:
+      hedge_slots.release()
+
+class _EtagIndex:
+  """sqlite index of the ETag, size and sha256 of every ZIP fetched into a given destination.
+
+  Each method opens its own connection so it can run in a worker thread, off the event loop.
+  """
+
+  def __init__(self, path):
+    self.path = os.path.expanduser(path)
+
+  def _connect(self):
+    Path(os.path.dirname(self.path)).mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(self.path)
+    conn.execute(
+      "CREATE TABLE IF NOT EXISTS files "
+      "(url TEXT, dest TEXT, etag TEXT, size INTEGER, sha256 TEXT, PRIMARY KEY (url, dest))")
+    return conn
+
+  def get_etags(self, keys):
+    with contextlib.closing(self._connect()) as conn:
+      etags = {}
+      for url, dest in keys:
+        row = conn.execute("SELECT etag FROM files WHERE url = ? AND dest = ?", (url, dest)).fetchone()
+        if row and row[0]:
+          etags[(url, dest)] = row[0]
+      return etags
+
+  def put_many(self, records):
+    # one transaction, so a whole batch costs a single commit
+    with contextlib.closing(self._connect()) as conn, conn:
+      conn.executemany(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+        [(url, dest, etag, len(body), hashlib.sha256(body).hexdigest()) for url, dest, etag, body in records])
 
+def get_backoff_sleep(base, attempts, max_backoff):
+  # linear growth plus jitter so parallel workers do not retry on the same boundary
+  return min(base * attempts, max_backoff) + random.uniform(0, base)
+
+class _AdaptiveLimiter:
+  """Concurrency limit that halves on HTTP 429 and doubles back after each quiet cool-down."""
+
+  def __init__(self, limit, cooldown):
+    self.limit = limit
+    self.capacity = limit
+    self.cooldown = cooldown
+    self.in_use = 0
+    self.last_change = 0
+    self.cond = asyncio.Condition()
+
+  def _has_slot(self):
+    now = asyncio.get_running_loop().time()
+    while self.capacity < self.limit and now - self.last_change >= self.cooldown:
+      self.capacity = min(self.limit, self.capacity * 2)
+      self.last_change += self.cooldown
+    return self.in_use < self.capacity
+
+  def throttle(self):
+    self.capacity = max(1, self.capacity // 2)
+    self.last_change = asyncio.get_running_loop().time()
+
+  async def __aenter__(self):
+    async with self.cond:
+      await self.cond.wait_for(self._has_slot)
+      self.in_use += 1
+
+  async def __aexit__(self, *exc_info):
+    async with self.cond:
+      self.in_use -= 1
+      self.cond.notify_all()
+
+async def _fetch(session, limiter, hedge_slots, fetched, url, dest, rates, backoff=1, max_backoff=64, etag=None):
+  # etag is only passed for files whose rows are already merged; only then may a 304 stand in for the body
+  headers = {"If-None-Match": etag} if etag else None
+  attempts = 0
+  failures = 0
+  while True:
+    try:
+      async with limiter:
+        status, etag, body = await _hedged_get(session, url, rates, hedge_slots, headers)
+      if status == 304:
+        print("\nFile unchanged, skipping: {}".format(url))
+        return None
+      tmp_path = dest + ".part"
+      async with aiofiles.open(tmp_path, 'wb') as out_file:
+        await out_file.write(body)
+      os.replace(tmp_path, dest)
+      fetched.append((url, dest, etag, body))
+      print("\nFile Download: {}".format(dest))
+      return body
+    except aiohttp.ClientResponseError as e:
+      if e.status == 429:
+        limiter.throttle()
+        attempts += 1
+        sleep_time = get_backoff_sleep(backoff, attempts, max_backoff)
+        print("Rate limited on {}. Sleeping for {:.1f} seconds...".format(url, sleep_time))
+        await asyncio.sleep(sleep_time)
+        continue
+      if e.status == 404:
+        print("\nFile not found: {}".format(url))
+        return None
+      if e.status < 500:
+        print("\nDownload failed: {} (HTTP {})".format(url, e.status))
+        return None
+      error = "HTTP {}".format(e.status)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+      # dropped connections, truncated payloads and timeouts are usually transient, like 5xx
+      error = "{}: {}".format(type(e).__name__, e)
+    # a single file's failure must not escape: it would cancel every other download in the TaskGroup
+    failures += 1
+    if failures > FETCH_RETRIES:
+      print("\nDownload failed after {} attempts: {} ({})".format(failures, url, error))
+      return None
+    sleep_time = get_backoff_sleep(backoff, failures, max_backoff)
+    print("Error on {} ({}). Retrying in {:.1f} seconds...".format(url, error, sleep_time))
+    await asyncio.sleep(sleep_time)
+
+def _read_file(path):
+  with open(path, 'rb') as f:
+    return f.read()
+
+def _batch_read_files(paths):
+  if not paths:
+    return []
+  # reads release the GIL, so a pool overlaps the per-file open/read latency
+  with ThreadPoolExecutor(max_workers=min(len(paths), MAX_CONNECTIONS)) as pool:
+    return list(pool.map(_read_file, paths))
+
+async def _gather(jobs, folder, backoff, max_backoff, revalidate):
+  connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST)
+  # keep HEDGE_MAX_INFLIGHT connections per host free so a hedge never queues behind the requests it is racing
+  limiter = _AdaptiveLimiter(MAX_CONNECTIONS_PER_HOST - HEDGE_MAX_INFLIGHT, RATE_LIMIT_COOLDOWN)
+  hedge_slots = asyncio.Semaphore(HEDGE_MAX_INFLIGHT)
+  index = _EtagIndex(ETAG_INDEX_PATH)
+  results = [None] * len(jobs)
+  cached = {}
+  to_fetch = {}
+  for i, (base_path, file_name) in enumerate(jobs):
+    download_url = get_download_url("{}{}".format(base_path, file_name))
+    conditional = (base_path, file_name) in revalidate
+    save_path = get_save_path(base_path, file_name, folder)
+    if os.path.exists(save_path):
+      print("\nfile already exists! {}".format(save_path))
+      cached[i] = save_path
+      continue
+    Path(os.path.dirname(save_path)).mkdir(parents=True, exist_ok=True)
+    to_fetch[i] = (download_url, os.path.abspath(save_path), conditional)
+  # the index is only consulted for revalidated files, in one lookup off the event loop
+  keys = [(url, dest) for url, dest, conditional in to_fetch.values() if conditional]
+  etags = await asyncio.to_thread(index.get_etags, keys) if keys else {}
+  fetched = []
+  tasks = {}
   try:
-    download_url = get_download_url(download_path)
-    dl_file = urllib.request.urlopen(download_url)
-    length = dl_file.getheader('content-length')
-    if length:
-      length = int(length)
-      blocksize = max(4096,length//100)
-
-    with open(save_path, 'wb') as out_file:
-      dl_progress = 0
-      print("\nFile Download: {}".format(save_path))
-      while True:
-        buf = dl_file.read(blocksize)   
-        if not buf:
-          break
-        dl_progress += len(buf)
-        out_file.write(buf)
-        done = int(50 * dl_progress / length)
-        sys.stdout.write("\r[%s%s]" % ('#' * done, '.' * (50-done)) )    
-        sys.stdout.flush()
-
-    return save_path
-  except urllib.error.HTTPError:
-    print("\nFile not found: {}".format(download_url))
-    pass
+    async with aiohttp.ClientSession(connector=connector, raise_for_status=True) as session:
+      async with asyncio.TaskGroup() as tg:
+        for i, (url, dest, conditional) in to_fetch.items():
+          tasks[i] = tg.create_task(_fetch(session, limiter, hedge_slots, fetched, url, dest, _rates, backoff, max_backoff, etags.get((url, dest))))
+        cached_read = tg.create_task(asyncio.to_thread(_batch_read_files, list(cached.values())))
+  finally:
+    if fetched:
+      await asyncio.to_thread(index.put_many, fetched)
+
+  for i, body in zip(cached, cached_read.result()):
+    results[i] = body
+  for i, task in tasks.items():
+    results[i] = task.result()
+  return results
+
+def download_files(jobs, folder=None, backoff=1, max_backoff=64, revalidate=()):
+  """Download every (base_path, file_name) pair concurrently, returning each body as bytes (None when missing or still failing after FETCH_RETRIES).
+
+  Pairs listed in revalidate are requested with If-None-Match and come back as None when unchanged;
+  only pass files whose contents have already been ingested.
+  """
+  return asyncio.run(_gather(jobs, folder, backoff, max_backoff, set(revalidate)))
 
+@functools.lru_cache(maxsize=None)
 def convert_to_date_object(d):
   year, month, day = [int(x) for x in d.split('-')]
   date_obj = date(year, month, day)